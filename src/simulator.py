@@ -1,5 +1,5 @@
 import numpy as np
-from shapely import Polygon, LineString, Point
+from shapely import Polygon
 
 # import matplotlib library
 import matplotlib.pyplot as plt
@@ -7,6 +7,119 @@ from matplotlib.patches import Circle
 import mkvideo
 import copy
 
+# numba is optional, without it the retina is computed with NumPy
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _retina_kernel(
+    retina,
+    agent_position,
+    agent_direction,
+    wall_p,
+    wall_d,
+    view_angle,
+    max_fov_distance,
+    pov_horizon,
+    scale,
+    agent_height,
+    wall_height,
+    pov_dist,
+):
+    """
+    Compute the retina in place, one ray (retina column) at a time.
+
+    Loop-based equivalent of the NumPy code in ArenaEnv.calculate_retina,
+    meant to be compiled with numba.
+
+    Parameters:
+    - retina: ndarray, the (height, width) retina to fill
+    - agent_position: ndarray, the (x, y) position of the agent
+    - agent_direction: float, the direction of the agent
+    - wall_p: ndarray, the (num_walls, 2) start points of the wall segments
+    - wall_d: ndarray, the (num_walls, 2) vectors of the wall segments
+    - view_angle: float, the angle of view of the agent
+    - max_fov_distance: float, the length of the rays
+    - pov_horizon: int, the row of the horizon in the retina
+    - scale: float, the scaling factor for the retina
+    - agent_height: float, the height of the agent
+    - wall_height: float, the height of the walls
+    - pov_dist: float, the distance of the agent's point of view
+
+    Returns: None
+    """
+    rows, width = retina.shape
+    num_walls = wall_p.shape[0]
+    two_pi = 2 * np.pi
+    angle_increment = view_angle / width
+    height = wall_height - agent_height
+
+    # Angles between the agent's position and each edge of the walls
+    edge_directions = np.empty(num_walls)
+    for j in range(num_walls):
+        edge_directions[j] = (
+            np.arctan2(
+                wall_p[j, 1] - agent_position[1],
+                wall_p[j, 0] - agent_position[0],
+            )
+            - angle_increment
+        ) % two_pi
+
+    retina[:, :] = 0
+    for i in range(width):
+        ray_angle = (
+            -view_angle / 2
+            + i * angle_increment
+            + angle_increment / 2
+            + agent_direction
+        )
+        rx = np.cos(ray_angle)
+        ry = np.sin(ray_angle)
+
+        # Distance of the nearest intersection between the ray and the walls
+        distance = np.inf
+        for j in range(num_walls):
+            wx = wall_d[j, 0]
+            wy = wall_d[j, 1]
+            denom = rx * wy - ry * wx
+            if denom != 0:
+                ox = wall_p[j, 0] - agent_position[0]
+                oy = wall_p[j, 1] - agent_position[1]
+                t = (ox * wy - oy * wx) / denom
+                u = (ox * ry - oy * rx) / denom
+                if 0 <= t <= max_fov_distance and 0 <= u <= 1 and t < distance:
+                    distance = t
+
+        # Base and height of the POV in retina coordinates
+        b = pov_horizon - int(agent_height / distance * pov_dist / scale)
+        h = pov_horizon + int(height / distance * pov_dist / scale)
+
+        # Check if an edge of the walls falls within the ray
+        lower_bound = (ray_angle - angle_increment / 2) % two_pi
+        upper_bound = (ray_angle + angle_increment / 2) % two_pi
+        is_edge = False
+        for j in range(num_walls):
+            if lower_bound < edge_directions[j] < upper_bound:
+                is_edge = True
+
+        if is_edge:
+            # Draw the whole inner wall
+            for r in range(rows):
+                if b < r < h:
+                    retina[r, i] = 1
+        else:
+            # Draw the base and height points only
+            if 0 <= b < rows:
+                retina[b, i] = 1
+            if 0 <= h < rows:
+                retina[h, i] = 1
+
+
+if njit is not None:
+    _retina_kernel = njit(cache=True)(_retina_kernel)
+
 
 class ArenaEnv:
     def __init__(
@@ -41,7 +154,7 @@ class ArenaEnv:
         self.num_walls = num_walls
 
         self.retina_dims = retina_dims
-        self.retina = np.zeros(self.retina_dims)
+        self.retina = np.zeros(self.retina_dims, dtype=np.uint8)
         self.retina_pov_horizon = retina_pov_horizon
         self.retina_scale = retina_scale
 
@@ -57,13 +170,10 @@ class ArenaEnv:
         # Calculate the wall view angle
         wall_view_angle = 2 * np.pi / self.num_walls
 
-        # Calculate the angles for each wall
-        angles = np.array([wall_view_angle * i for i in range(self.num_walls)])
-
-        # Concatenate the angles array with the first angle to form a loop
-        angles = np.hstack([angles[: self.num_walls], angles[0]])
-
-        # Adjust the angles to center the walls
+        # Calculate the angles for each wall, closing the loop with the first
+        # angle and adjusting the angles to center the walls
+        angles = wall_view_angle * np.arange(self.num_walls + 1)
+        angles[-1] = 0
         angles -= wall_view_angle / 2
 
         # Generate the collisiom wall coordinates based on the angles
@@ -87,6 +197,40 @@ class ArenaEnv:
             ]
         )
 
+        # Store the collision wall segments start points and their inward
+        # normals (the polygon vertices are counterclockwise) used for the
+        # containment test
+        collision_coords = np.array(self.collision_walls.exterior.coords)
+        self.collision_wall_p = collision_coords[:-1]
+        collision_wall_d = collision_coords[1:] - collision_coords[:-1]
+        self.collision_wall_normals = np.stack(
+            [-collision_wall_d[:, 1], collision_wall_d[:, 0]], axis=1
+        )
+
+        # Store the wall segments (start points and edge vectors) used for
+        # the analytic ray/wall intersection
+        wall_coords = np.array(self.walls.exterior.coords)
+        self.wall_p = wall_coords[:-1]
+        self.wall_q = wall_coords[1:]
+        self.wall_d = self.wall_q - self.wall_p
+
+        # Store the per-step invariants of the retina computation: the ray
+        # angles relative to the agent direction, the retina column and row
+        # indices and the length of the rays
+        self._angle_increment = self.agent_view_angle / self.retina_dims[1]
+        self._retina_indices = np.arange(self.retina_dims[1])
+        self._ray_angle_offsets = (
+            -self.agent_view_angle / 2
+            + self._retina_indices * self._angle_increment
+            + self._angle_increment / 2
+        )
+        self._col = np.arange(self.retina_dims[0]).reshape(-1, 1)
+        self._max_fov_distance = 10 * self.wall_dist
+
+        # Buffers for the angular bounds of the rays
+        self._lb_buf = np.empty(self.retina_dims[1])
+        self._ub_buf = np.empty(self.retina_dims[1])
+
         self.vars = [v for v in self.__dict__]
         
         self.reset()
@@ -117,23 +261,6 @@ class ArenaEnv:
 
         return self.retina[::-1].reshape(-1)
 
-    def find_angle(self, p1, p2):
-        """
-        Calculate the angle between two points.
-
-        Args:
-            p1 (np.ndarray): The coordinates of the first point (x1, y1) as a 2D array.
-            p2 (np.ndarray): The coordinates of the second point (x2, y2) as a 2D array.
-
-        Returns:
-            np.ndarray: The angles between the two points in radians.
-        """
-        dx = p2[:, 0] - p1[:, 0]
-        dy = p2[:, 1] - p1[:, 1]
-        angle_rad = np.arctan2(dy, dx)
-        angle_rad %= 2 * np.pi
-        return angle_rad
-
     def step(self, speed, direction):
         """
         Take a step in the environment.
@@ -151,8 +278,12 @@ class ArenaEnv:
         new_position = self.agent_position + speed * np.array(
             [np.cos(new_direction), np.sin(new_direction)]
         )
-        if self.collision_walls.contains(Point(new_position)):
-            self.agent_position = new_position.copy()
+        inside = (
+            (new_position - self.collision_wall_p)
+            * self.collision_wall_normals
+        ).sum(axis=1) > 0
+        if np.all(inside):
+            self.agent_position = new_position
         self.agent_direction = new_direction
 
         # update the agent's direction
@@ -160,12 +291,16 @@ class ArenaEnv:
         
         self.calculate_retina()
 
-        rew = Point(*self.reward).buffer(self.reward_radius)
-        agent = Point(*self.agent_position).buffer(self.agent_radius)
-        reward = 1.0 * agent.exterior.crosses(rew.exterior)
+        # The agent gets the reward when its border crosses the reward border
+        reward_dist = np.linalg.norm(self.agent_position - self.reward)
+        reward = 1.0 * (
+            abs(self.agent_radius - self.reward_radius)
+            < reward_dist
+            < self.agent_radius + self.reward_radius
+        )
 
         self.position_history = np.vstack(
-            [self.position_history[1:], self.agent_position.copy()]
+            [self.position_history[1:], self.agent_position]
         )
 
         # Return the updated retina and reward
@@ -175,53 +310,66 @@ class ArenaEnv:
         pass
 
     def calculate_retina(self):
-        angle_increment = self.agent_view_angle / self.retina_dims[1]
-
+        if njit is not None:
+            _retina_kernel(
+                self.retina,
+                self.agent_position,
+                self.agent_direction,
+                self.wall_p,
+                self.wall_d,
+                self.agent_view_angle,
+                self._max_fov_distance,
+                self.retina_pov_horizon,
+                self.retina_scale,
+                self.agent_height,
+                self.wall_height,
+                self.agent_pov_dist,
+            )
+            return
+
+        angle_increment = self._angle_increment
         
         # This code block calculates the angles between the agent's current
         # position and each edge of the walls.
-        agent_edge_directions = self.find_angle(self.agent_position.reshape(1, -1), np.array(self.walls.exterior.xy).T[:-1])
-        agent_edge_directions -= angle_increment
-        agent_edge_directions %= 2 * np.pi
+        edge_offsets = self.wall_p - self.agent_position
+        agent_edge_directions = np.mod(
+            np.arctan2(edge_offsets[:, 1], edge_offsets[:, 0])
+            - angle_increment,
+            2 * np.pi,
+        )
 
-        self.retina *= 0
+        self.retina.fill(0)
 
         # Iterate over each column of the retina
-        retina_indices = np.arange(self.retina_dims[1])
-        ray_angles = (
-            -self.agent_view_angle / 2
-            + retina_indices * angle_increment
-            + angle_increment / 2
-            + self.agent_direction
-        )
-        max_fov_distance = 10 * self.wall_dist
+        retina_indices = self._retina_indices
+        ray_angles = self._ray_angle_offsets + self.agent_direction
+        max_fov_distance = self._max_fov_distance
 
-        # Compute the coordinates of all rays
+        # Compute the unit direction vectors of all rays
         ray_directions = np.column_stack(
-            [
-                max_fov_distance * np.cos(ray_angles),
-                max_fov_distance * np.sin(ray_angles),
-            ]
+            [np.cos(ray_angles), np.sin(ray_angles)]
         )
-        ray_starts = np.tile(self.agent_position, (len(retina_indices), 1))
-        ray_ends = ray_starts + ray_directions
-        rays = np.column_stack([ray_starts, ray_ends])
-
-        # Create LineString objects for all rays
-        ray_lines = [LineString(ray.reshape(2, 2)) for ray in rays]
 
-        # Compute the distances between the rays and the walls
-        intersections = [
-            self.walls.exterior.intersection(ray) for ray in ray_lines
-        ]
-        distances = np.array(
-            [
-                np.linalg.norm(
-                    np.hstack(intersection.xy) - self.agent_position
-                )
-                for intersection in intersections
-            ]
+        # Solve agent_position + t * ray_direction = wall_p + u * wall_d for
+        # each (ray, wall) pair, shape (rays, walls)
+        offsets = edge_offsets[None, :, :]
+        rx, ry = ray_directions[:, None, 0], ray_directions[:, None, 1]
+        wx, wy = self.wall_d[None, :, 0], self.wall_d[None, :, 1]
+        denom = rx * wy - ry * wx
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (offsets[..., 0] * wy - offsets[..., 1] * wx) / denom
+            u = (offsets[..., 0] * ry - offsets[..., 1] * rx) / denom
+
+        # Keep the nearest valid hit of each ray, with unit directions t is
+        # the distance from the agent
+        hits = (
+            (denom != 0)
+            & (t >= 0)
+            & (t <= max_fov_distance)
+            & (u >= 0)
+            & (u <= 1)
         )
+        distances = np.where(hits, t, np.inf).min(axis=1)
 
         # Compute the base and height of the POV
         height = self.wall_height - self.agent_height
@@ -237,58 +385,65 @@ class ArenaEnv:
         h = self.retina_pov_horizon + h
 
         # Update the retina with the points of interest
-        valid_b_indices = np.where((0 <= b) & (b < self.retina_dims[0]))
-        valid_h_indices = np.where((0 <= h) & (h < self.retina_dims[0]))
-        self.retina[
-            b[valid_b_indices],
-            retina_indices[valid_b_indices],
-        ] = 1
-        self.retina[
-            h[valid_h_indices],
-            retina_indices[valid_h_indices],
-        ] = 1
+        valid_b = (0 <= b) & (b < self.retina_dims[0])
+        valid_h = (0 <= h) & (h < self.retina_dims[0])
+        self.retina[b[valid_b], retina_indices[valid_b]] = 1
+        self.retina[h[valid_h], retina_indices[valid_h]] = 1
 
         # Compute the lower bound angles by subtracting half of the angle
         # increment from ray angles
-        lower_bounds = ray_angles - angle_increment / 2
+        lower_bounds = np.subtract(
+            ray_angles, angle_increment / 2, out=self._lb_buf
+        )
 
         # Compute the upper bound angles by adding half of the angle increment
         # to ray angles
-        upper_bounds = ray_angles + angle_increment / 2
+        upper_bounds = np.add(
+            ray_angles, angle_increment / 2, out=self._ub_buf
+        )
 
         # Normalize the lower and upper bound angles to be between 0 and 2*pi
-        lower_bounds %= 2 * np.pi
-        upper_bounds %= 2 * np.pi
-
-        # Reshape the lower bounds, upper bounds, and agent edge directions
-        # arrays for comparison
-        lb = lower_bounds.reshape(-1, 1)
-        ub = upper_bounds.reshape(-1, 1)
-        ad = agent_edge_directions.reshape(1, -1)
-
-        # Determine the edges by checking if the lower bound is less than the
-        # agent edge direction and if the agent edge direction is less than the
-        # upper bound
-        edges = np.logical_and(lb < ad, ad < ub)
+        np.mod(lower_bounds, 2 * np.pi, out=lower_bounds)
+        np.mod(upper_bounds, 2 * np.pi, out=upper_bounds)
+
+        # Find the ray whose angular interval would contain each agent edge
+        # direction, edges outside the field of view get no ray
+        edge_rays = np.floor(
+            np.mod(agent_edge_directions - lower_bounds[0], 2 * np.pi)
+            / angle_increment
+        ).astype(int)
+        edge_directions = agent_edge_directions[edge_rays < len(ray_angles)]
+        edge_rays = edge_rays[edge_rays < len(ray_angles)]
+
+        # Keep the edges by checking if the lower bound of their ray is less
+        # than the agent edge direction and if the agent edge direction is
+        # less than the upper bound
+        edges = np.logical_and(
+            lower_bounds[edge_rays] < edge_directions,
+            edge_directions < upper_bounds[edge_rays],
+        )
 
         # Get the indices of the edges in the retina array
-        edges_in_retina = np.where(edges)[0]
+        edges_in_retina = edge_rays[edges]
+        if len(edges_in_retina) == 0:
+            return
 
-        # Reshape the column indices array for comparison with the wall
+        # Column indices array reshaped for comparison with the wall
         # boundaries
-        col = np.arange(self.retina_dims[0]).reshape(-1, 1)
+        col = self._col
 
-        # Reshape the boundaries array for comparison with the column indices
-        b = b.reshape(1, -1)
-        h = h.reshape(1, -1)
+        # Take the boundaries of the edge columns only, reshaped for
+        # comparison with the column indices
+        edge_b = b[edges_in_retina][None, :]
+        edge_h = h[edges_in_retina][None, :]
 
         # Determine the inner wall boundaries by checking if the column index
         # is within the boundaries
-        inner_wall = np.logical_and(b < col, col < h)
+        inner_wall = np.logical_and(edge_b < col, col < edge_h)
 
         # Set the values of the retina array to 1 where there are edges in the
         # inner wall
-        self.retina[:, edges_in_retina] = 1 * inner_wall[:, edges_in_retina]
+        self.retina[:, edges_in_retina] = inner_wall
 
 class GraphArena(ArenaEnv):
     """Class for creating a graphical representation of the environment"""
@@ -304,6 +459,8 @@ class GraphArena(ArenaEnv):
         self.g_retina = self.axes[0].imshow(
             np.zeros(self.retina_dims), cmap=plt.cm.binary, vmin=0, vmax=1
         )
+        # Buffer for the displayed retina
+        self.retina_image = np.empty(self.retina_dims)
         self.axes[0].set_axis_off()
 
         self.axes[1].set_axis_off()
@@ -324,11 +481,49 @@ class GraphArena(ArenaEnv):
         (self.g_agent_nose,) = self.axes[1].plot(
             [0, 0.01], [0, 0], c='black', zorder=2
         )
+        # Buffer for the offsets of the nose ends from the agent position
+        self.nose_offsets = np.zeros((2, 2))
         self.g_reward = Circle(self.reward, self.reward_radius, zorder=-1)
         self.axes[1].add_patch(self.g_reward)
 
         self.vm = mkvideo.vidManager(self.fig,"episode", ".", 200)
 
+        # When online, the moving artists are blitted on the cached
+        # backgrounds of their axes instead of redrawing the whole figure
+        self.moving_artists = [
+            (self.axes[0], [self.g_retina]),
+            (self.axes[1], [self.g_hist, self.g_agent, self.g_agent_nose]),
+        ]
+        self.backgrounds = None
+        if not self.offline:
+            for _, artists in self.moving_artists:
+                for artist in artists:
+                    artist.set_animated(True)
+            self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        """Cache the axes backgrounds after a full draw of the figure"""
+
+        self.backgrounds = [
+            self.fig.canvas.copy_from_bbox(ax.bbox)
+            for ax, _ in self.moving_artists
+        ]
+        for ax, artists in self.moving_artists:
+            for artist in artists:
+                ax.draw_artist(artist)
+
+    def blit(self):
+        """Redraw only the moving artists over the cached backgrounds"""
+
+        for (ax, artists), background in zip(
+            self.moving_artists, self.backgrounds
+        ):
+            self.fig.canvas.restore_region(background)
+            for artist in artists:
+                ax.draw_artist(artist)
+            self.fig.canvas.blit(ax.bbox)
+        self.fig.canvas.flush_events()
+
     def close(self):
         
         plt.close(self.fig)
@@ -349,29 +544,25 @@ class GraphArena(ArenaEnv):
 
         ret = super(GraphArena, self).step(*args, **kargs)
 
-        self.g_retina.set_data(0.2 + 0.8 * self.retina)
+        np.multiply(self.retina, 0.8, out=self.retina_image)
+        self.retina_image += 0.2
+        self.g_retina.set_data(self.retina_image)
         self.g_agent.center = self.agent_position
 
         # Calculate the position of the agent's nose
-        nose = self.agent_position + np.stack(
-            [
-                [0, 0],
-                0.3
-                * np.array(
-                    [
-                        np.cos(self.agent_direction),
-                        np.sin(self.agent_direction),
-                    ]
-                ),
-            ]
-        )
-        self.g_agent_nose.set_data(*nose.T)
+        self.nose_offsets[1, 0] = 0.3 * np.cos(self.agent_direction)
+        self.nose_offsets[1, 1] = 0.3 * np.sin(self.agent_direction)
+        nose = self.agent_position + self.nose_offsets
+        self.g_agent_nose.set_data(nose[:, 0], nose[:, 1])
         self.g_hist.set_data(*self.position_history.T)
 
         if self.offline:
             self.vm.save_frame()
-        else:
+        elif self.backgrounds is None:
+            # First full draw, it also caches the backgrounds
             plt.pause(0.1)
+        else:
+            self.blit()
 
         return ret
 